@@ -5,9 +5,19 @@ from functools import partial
 
 import geopandas as gp
 import numpy as np
+import pandas as pd
 from pyogrio import read_dataframe
-from shapely import get_coordinates, line_merge, set_precision, unary_union
-from shapely.geometry import LineString, MultiLineString, Point
+from shapely import (
+    buffer,
+    get_coordinates,
+    get_parts,
+    line_merge,
+    linestrings,
+    multilinestrings,
+    points,
+    set_precision,
+    unary_union,
+)
 
 START = dt.datetime.now()
 CRS = "EPSG:27700"
@@ -26,11 +36,8 @@ def combine_line(line):
       join LineString GeoSeries
 
     """
-    r = MultiLineString(line.values)
-    try:
-        return gp.GeoSeries(line_merge(r).geoms, crs=CRS)
-    except AttributeError:
-        return gp.GeoSeries(line_merge(r), crs=CRS)
+    r = line_merge(multilinestrings(line.values))
+    return gp.GeoSeries(get_parts(r), crs=CRS)
 
 def get_base_geojson(filepath):
     """get_base_nx: return GeoDataFrame at 0.1m precision from GeoJSON
@@ -42,23 +49,44 @@ def get_base_geojson(filepath):
       GeoDataFrame at 0.1m precision
 
     """
-    r = read_dataframe(filepath).to_crs(CRS)
-    r["geometry"] = r["geometry"].map(set_precision_pointone)
+    r = read_dataframe(filepath, use_arrow=True).to_crs(CRS)
+    r["geometry"] = set_precision_pointone(r["geometry"].values)
     return r
 
 
+def get_coordinate_range(geometry):
+    """get_coordinate_range: return coordinates of a geometry array with the offset of
+    the first and last coordinate of each geometry, raising ValueError on an empty
+    geometry as it has no first or last coordinate
+
+    args:
+      geometry: geometry array
+
+    returns:
+      coordinate and geometry index numpy arrays, and (start, end) offset numpy arrays
+
+    """
+    xy, ix = get_coordinates(geometry, return_index=True)
+    n = np.arange(len(geometry))
+    start = np.searchsorted(ix, n)
+    end = np.searchsorted(ix, n, side="right") - 1
+    if (start > end).any():
+        raise ValueError("empty geometry has no end coordinates")
+    return xy, ix, start, end
+
+
 def get_end(geometry):
     """get_end: return numpy array of geometry LineString end-points
 
     args:
-      geometry: geometry LineString
+      geometry: LineString geometry array
 
     returns:
-      end-point numpy arrays
+      (start, end) end-point numpy array for each LineString
 
     """
-    r = get_coordinates(geometry)
-    return np.vstack((r[0, :], r[-1, :]))
+    r, _, start, end = get_coordinate_range(geometry)
+    return np.stack([r[start], r[end]], axis=1)
 
 
 def get_geometry_buffer(this_gf, radius=8.0):
@@ -72,17 +100,9 @@ def get_geometry_buffer(this_gf, radius=8.0):
       buffered GeoSeries geometry
 
     """
-    try:
-        r = gp.GeoSeries(unary_union(this_gf).geoms, crs=CRS)
-    except AttributeError:
-        r = gp.GeoSeries(this_gf, crs=CRS)
-    r = gp.GeoSeries(r, crs=CRS).buffer(radius, join_style="mitre")
-    union = unary_union(r)
-    try:
-        r = gp.GeoSeries(union.geoms, crs=CRS)
-    except AttributeError:
-        r = gp.GeoSeries(union, crs=CRS)
-    return r
+    r = get_parts(unary_union(this_gf.values))
+    r = buffer(r, radius, quad_segs=16, join_style="mitre")
+    return gp.GeoSeries(get_parts(unary_union(r)), crs=CRS)
 
 
 def get_nx(line):
@@ -95,11 +115,8 @@ def get_nx(line):
       edge GeoDataFrames
 
     """
-    r = line.map(get_end)
-    edge = gp.GeoSeries(r.map(LineString), crs=CRS)
-    r = np.vstack(r.to_numpy())
-    r = gp.GeoSeries(map(Point, r)).to_frame("geometry")
-    r = r.groupby(r.columns.to_list(), as_index=False).size()
+    r = get_end(line.values)
+    edge = gp.GeoSeries(linestrings(r), index=line.index, crs=CRS)
     return edge
 
 
@@ -114,17 +131,15 @@ def get_source_target(line):
       edge, node: GeoDataFrames
 
     """
-    edge = line.copy()
-    r = edge["geometry"].map(get_end)
-    r = np.stack(r)
-    node = gp.GeoSeries(map(Point, r.reshape(-1, 2)), crs=CRS).to_frame("geometry")
-    count = node.groupby("geometry").size().rename("count")
-    node = node.drop_duplicates("geometry").set_index("geometry", drop=False)
-    node = node.join(count).reset_index(drop=True).reset_index(names="node")
-    ix = node.set_index("geometry")["node"]
-    edge = edge.reset_index(names="edge")
-    edge["source"] = ix.loc[map(Point, r[:, 0])].values
-    edge["target"] = ix.loc[map(Point, r[:, 1])].values
+    r = get_end(line["geometry"].values).reshape(-1, 2)
+    # hash each (x, y) end-point as a single complex128 value
+    codes, uniques = pd.factorize(r.view(np.complex128).ravel())
+    node = gp.GeoSeries(points(uniques.view(np.float64).reshape(-1, 2)), crs=CRS)
+    node = node.to_frame("geometry").reset_index(names="node")
+    node["count"] = np.bincount(codes)
+    edge = line.reset_index(names="edge")
+    edge["source"] = codes[0::2]
+    edge["target"] = codes[1::2]
     return edge, node
 
 
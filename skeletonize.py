@@ -6,22 +6,35 @@ import warnings
 from functools import partial
 
 import geopandas as gp
-import networkx as nx
 import numpy as np
 import pandas as pd
 import rasterio as rio
 import rasterio.features as rif
+from numba import njit, prange
 from pyogrio import write_dataframe
-from shapely import line_interpolate_point, set_precision, snap
-from shapely.affinity import affine_transform
-from shapely.geometry import LineString, MultiPoint, Point
-from shapely.ops import split
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from shapely import (
+    get_coordinates,
+    get_geometry,
+    get_parts,
+    is_empty,
+    length,
+    linestrings,
+    multilinestrings,
+    reverse,
+    set_precision,
+    simplify,
+    transform,
+    unary_union,
+)
+from shapely.geometry import LineString
 from skimage.morphology import remove_small_holes, skeletonize
 
 from shared import (
-    combine_line,
     CRS,
     get_base_geojson,
+    get_coordinate_range,
     get_geometry_buffer,
     get_nx,
     get_source_target,
@@ -55,6 +68,9 @@ def get_args():
     parser.add_argument("--scale", help="raster scale", type=float, default=1.0)
     parser.add_argument("--knot", help="keep image knots", action="store_true")
     parser.add_argument("--segment", help="segment", action="store_true")
+    parser.add_argument(
+        "--gpu", help="thin on GPU with cucim, differs from CPU", action="store_true"
+    )
     args = parser.parse_args()
     return {
         "inpath": args.inpath,
@@ -64,6 +80,7 @@ def get_args():
         "scale": args.scale,
         "knot": args.knot,
         "segment": args.segment,
+        "gpu": args.gpu,
     }
 
 
@@ -102,61 +119,91 @@ def get_affine_transform(this_gf, scale=1.0):
 
 
 def get_raster_point(raster, value=1):
-    """get_raster_point: return Point GeoSeries from raster array with values >= value
+    """get_raster_point: return (row, column) pixel array from raster array with
+    values >= value
 
     args:
       raster: raster numpy array
       value: point threshold (default value = 1)
     returns:
-      GeoSeries Point
+      (row, column) integer pixel numpy array
 
     """
-    r = np.stack(np.where(raster >= value))
-    return gp.GeoSeries(map(Point, r.T), crs=CRS)
+    return np.argwhere(raster >= value)
 
 
-def sx_to_nx(this_gf, transform, simplify=0.0):
+def sx_to_nx(this_gf, matrix, tolerance=0.0):
     """sx_to_nx: transform GeoPandas data from raster to projected coordinates
 
     args:
       this_gf: GeoDataFrame raster coordinates
-      transform: affine transform
+      matrix: shapely affine transformation matrix
+      tolerance: simplify tolerance [m] (default 0.0)
 
     returns:
       GeoDataFrame in projected coordinates
 
     """
-    r = this_gf.copy()
     try:
-        r = r.to_frame("geometry")
+        r = this_gf.to_frame("geometry")
     except AttributeError:
-        pass
-    geometry = r["geometry"].map(transform).map(set_precision_pointone)
-    if simplify > 0.0:
-        geometry = geometry.simplify(simplify)
-    r["geometry"] = geometry
+        r = this_gf.copy(deep=False)
+    m = matrix[[0, 2, 1, 3]].reshape(2, 2)
+    geometry = transform(r["geometry"].values, lambda xy: xy @ m + matrix[4:])
+    geometry = set_precision_pointone(geometry)
+    if tolerance > 0.0:
+        geometry = simplify(geometry, tolerance)
+    r["geometry"] = gp.GeoSeries(geometry, index=r.index, crs=CRS)
     return r
 
 
-def get_skeleton(geometry, transform, shape, hole_size):
+def get_skeleton(geometry, r_matrix, shape, hole_size, gpu=False):
     """get_skeleton: return skeletonized raster buffer from Shapely geometry
 
     args:
       geometry: Shapely geometry to convert to raster buffer
-      transform: rasterio affine transformation
+      r_matrix: rasterio affine transformation
       shape: output buffer px size
       hole_size: size of hole to remove
+      gpu: remove holes and thin on the GPU with cupy and cucim (default False)
 
     returns:
-      skeltonized numpy array raster buffer
+      skeltonized boolean numpy array raster buffer
 
     """
-    r = rif.rasterize(geometry.values, transform=transform, out_shape=shape)
+    r = np.zeros(shape, dtype=np.uint8)
+    rif.rasterize(geometry.values, transform=r_matrix, out=r)
+    r = r.view(bool)
+    if gpu:
+        return get_skeleton_gpu(r, hole_size)
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         # parent, traverse = max_tree(invert(r))
-        r = remove_small_holes(r, hole_size).astype(np.uint8)
-    return skeletonize(r).astype(np.uint8)
+        remove_small_holes(r, hole_size, out=r)
+    return skeletonize(r)
+
+
+def get_skeleton_gpu(raster, hole_size):
+    """get_skeleton_gpu: return thinned raster buffer using cupy and cucim, as cucim
+    has no skeletonize the 1px lines may differ from the CPU skeletonize output
+
+    args:
+      raster: boolean numpy array raster buffer
+      hole_size: size of hole to remove
+
+    returns:
+      thinned boolean numpy array raster buffer
+
+    """
+    import cupy as cp
+    from cucim.skimage.morphology import remove_small_holes as remove_gpu_hole
+    from cucim.skimage.morphology import thin
+
+    r = cp.asarray(raster)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        r = remove_gpu_hole(r, hole_size)
+    return cp.asnumpy(thin(r))
 
 
 def get_connected_class(edge_list):
@@ -169,10 +216,13 @@ def get_connected_class(edge_list):
       labeled node pandas Series
 
     """
-    nx_graph = nx.from_pandas_edgelist(edge_list)
-    connected = nx.connected_components(nx_graph)
-    r = {k: i for i, j in enumerate(connected) for k in j}
-    return pd.Series(r, name="class")
+    ix, node = pd.factorize(edge_list[["source", "target"]].values.T.reshape(-1))
+    n = node.size
+    source, target = ix.reshape(2, -1)
+    weight = np.ones(source.size, dtype=bool)
+    graph = coo_matrix((weight, (source, target)), shape=(n, n))
+    _, r = connected_components(graph, directed=False)
+    return pd.Series(r, index=node, name="class")
 
 
 def get_centre_edge(node):
@@ -185,103 +235,273 @@ def get_centre_edge(node):
       GeoDataCentre node cluster centroid Point
 
     """
-    centre = node[["geometry", "class"]].groupby("class").aggregate(tuple)
-    centre = gp.GeoSeries(centre["geometry"].map(MultiPoint), crs=CRS).centroid
-    centre = centre.rename("target")
-    geometry = node[["class", "geometry"]].set_index("class").join(centre)
-    geometry = geometry.apply(LineString, axis=1)
-    r = node.rename(columns={"node": "source"}).copy()
-    r["geometry"] = geometry.values
+    xy = get_coordinates(node["geometry"].values)
+    ix, _ = pd.factorize(node["class"])
+    count = np.bincount(ix)
+    centre = np.stack([np.bincount(ix, xy[:, 0]), np.bincount(ix, xy[:, 1])], axis=1)
+    centre = centre / count[:, np.newaxis]
+    return gp.GeoDataFrame(
+        {"source": node["node"].values, "class": node["class"].values},
+        geometry=linestrings(np.stack([xy, centre[ix]], axis=1)),
+        index=node.index,
+        crs=CRS,
+    )
+
+
+@njit("int64[:, :](boolean[:, :])", parallel=True, cache=True)
+def get_raster_edge(raster):
+    """get_raster_edge: return index pairs of 8-neighbour adjacent raster pixels, where
+    pixels are numbered in row-major order as in get_raster_point
+
+    args:
+      raster: boolean 1px line raster numpy array
+
+    returns:
+      (source, target) pixel index numpy array with source < target
+
+    """
+    h, w = raster.shape
+    start = np.zeros(h + 1, dtype=np.int64)
+    count = np.zeros(h + 1, dtype=np.int64)
+    for i in prange(h):
+        for j in range(w):
+            if not raster[i, j]:
+                continue
+            start[i + 1] += 1
+            if j + 1 < w and raster[i, j + 1]:
+                count[i + 1] += 1
+            if i + 1 < h:
+                for k in range(max(j - 1, 0), min(j + 2, w)):
+                    if raster[i + 1, k]:
+                        count[i + 1] += 1
+    start = np.cumsum(start)
+    count = np.cumsum(count)
+    r = np.empty((count[-1], 2), dtype=np.int64)
+    for i in prange(h):
+        n, c = start[i], count[i]
+        m, q = start[i + 1], 0
+        for j in range(w):
+            if not raster[i, j]:
+                continue
+            if j + 1 < w and raster[i, j + 1]:
+                r[c, 0], r[c, 1] = n, n + 1
+                c += 1
+            if i + 1 < h:
+                while q < j - 1:
+                    if raster[i + 1, q]:
+                        m += 1
+                    q += 1
+                t = m
+                for k in range(q, min(j + 2, w)):
+                    if raster[i + 1, k]:
+                        r[c, 0], r[c, 1] = n, t
+                        t += 1
+                        c += 1
+            n += 1
     return r
 
 
-def get_raster_line(point, knot=False):
+@njit(
+    "Tuple((int64[:], boolean[:], int64[:]))(int64[:, :], int64[:], int64[:])",
+    cache=True,
+)
+def get_chain(edge, adjacent, offset):
+    """get_chain: return edge walk merging chains through degree 2 nodes
+
+    args:
+      edge: (source, target) node index numpy array
+      adjacent: 2 * edge + 0 at source or 1 at target, for each node in turn
+      offset: start of each node in adjacent, with adjacent size appended
+
+    returns:
+      edge index, reversed flag and chain index numpy arrays in walk order
+
+    """
+    m = edge.shape[0]
+    visited = np.zeros(m, dtype=np.bool_)
+    step = np.empty(m, dtype=np.int64)
+    flip = np.empty(m, dtype=np.bool_)
+    chain = np.empty(m, dtype=np.int64)
+    k, c = 0, 0
+    # chains start at end and junction nodes, then what is left are rings
+    for ring in (False, True):
+        for v in range(offset.size - 1):
+            if (offset[v + 1] - offset[v] == 2) != ring:
+                continue
+            for a in range(offset[v], offset[v + 1]):
+                e, side, j = adjacent[a] // 2, adjacent[a] % 2, k
+                while not visited[e]:
+                    visited[e] = True
+                    step[k], flip[k], chain[k] = e, side == 1, c
+                    k += 1
+                    u = edge[e, 1 - side]
+                    if offset[u + 1] - offset[u] != 2:
+                        break
+                    # leave a degree 2 node on its other edge
+                    for b in range(offset[u], offset[u + 1]):
+                        if adjacent[b] // 2 != e:
+                            e, side = adjacent[b] // 2, adjacent[b] % 2
+                            break
+                if k > j:
+                    c += 1
+    return step, flip, chain
+
+
+def merge_line(line):
+    """merge_line: return LineString GeoSeries merging lines through degree 2 nodes,
+    in the same order and direction as shapely line_merge
+
+    args:
+      line: LineString geometry array
+
+    returns:
+      merged LineString GeoSeries
+
+    """
+    # as line_merge, skip zero length lines
+    line = line[length(line) > 0.0]
+    m = len(line)
+    xy, ix, start, end = get_coordinate_range(line)
+    # number end points in (x, y) order as the line_merge node map
+    p = np.r_[xy[start], xy[end]]
+    _, node = np.unique(p.view(np.complex128).ravel(), return_inverse=True)
+    edge = node.reshape(2, -1).T.copy()
+    # order each node's lines anti-clockwise from east as line_merge
+    d = np.r_[xy[start + 1], xy[end - 1]] - p
+    angle = np.arctan2(d[:, 1], d[:, 0]) % (2.0 * np.pi)
+    adjacent = np.r_[2 * np.arange(m), 2 * np.arange(m) + 1]
+    adjacent = adjacent[np.lexsort((angle, node))]
+    offset = np.r_[0, np.cumsum(np.bincount(node))]
+    step, flip, chain = get_chain(edge, adjacent, offset)
+    # each step adds count coordinates of its line, less the first where it
+    # continues the chain of the previous step
+    count = (end - start + 1)[step]
+    skip = np.r_[False, chain[1:] == chain[:-1]].astype(np.int64)
+    n = count - skip
+    # k: step of each output coordinate, j: its position along the step line
+    k = np.repeat(np.arange(step.size), n)
+    j = np.arange(k.size) - np.repeat(np.cumsum(n) - n, n) + skip[k]
+    j = np.where(flip[k], count[k] - 1 - j, j)
+    r = linestrings(xy[start[step][k] + j], indices=chain[k])
+    # as line_merge, reverse chains walked mostly against their line direction
+    ix = 2 * np.bincount(chain, flip) > np.bincount(chain)
+    r[ix] = reverse(r[ix])
+    return gp.GeoSeries(r, crs=CRS)
+
+
+def get_raster_line(raster, knot=False):
     """get_raster_line: return LineString GeoSeries from 1px line raster eliminating knots
 
     args:
-      point: 1px raster array with knots
+      raster: boolean 1px line raster with knots
 
     returns:
       1px line LineString GeoSeries with knots removed
 
     """
-    square = point.buffer(1, cap_style="square", mitre_limit=1)
-    ix = point.sindex.query(square, predicate="covers").T
-    ix = np.sort(ix)
-    s = pd.DataFrame(ix).drop_duplicates().reset_index(drop=True)
-    s = s.loc[np.where(s[0] != s[1])]
-    s = np.stack([point[s[0].values], point[s[1].values]]).T
-    r = gp.GeoSeries(map(LineString, s), crs=CRS)
-    if r.empty:
+    point = get_raster_point(raster)
+    ix = get_raster_edge(raster)
+    if ix.size == 0:
         return gp.GeoSeries(EMPTY, crs=CRS)
-    edge, node = get_source_target(combine_line(r).to_frame("geometry"))
+    s = np.stack([point[ix[:, 0]], point[ix[:, 1]]], axis=1)
+    r = merge_line(linestrings(s.astype(np.float64)))
+    edge, node = get_source_target(r.to_frame("geometry"))
     if knot:
-        return combine_line(edge["geometry"])
+        return edge["geometry"]
     ix = edge.length > 2.0
     connected = get_connected_class(edge.loc[~ix, ["source", "target"]])
     if connected.empty:
         return edge.loc[ix, "geometry"]
     node = node.loc[connected.index].join(connected).sort_index()
     connected_edge = get_centre_edge(node)
-    r = combine_line(pd.concat([connected_edge["geometry"], edge.loc[ix, "geometry"]]))
+    r = np.r_[connected_edge["geometry"].values, edge.loc[ix, "geometry"].values]
+    r = merge_line(r)
     return r[r.length > 2.0]
 
 
-def get_split(line, point, separation=1.0e-6):
-    """get_split:"""
-    return list(split(snap(line, point, separation), point).geoms)
+def split_centres(line, offset):
+    """split_centres: return LineString array trimmed by offset at both ends
 
+    args:
+      line: LineString or MultiLineString geometry array
+      offset: length to trim from each end
 
-def split_centres(line, offset):
-    """split_centres:"""
-    if line.length <= 2.0 * offset:
-        return EMPTY
-    p = line_interpolate_point(line, offset)
-    _, centre = get_split(line, p)
-    p = line_interpolate_point(centre, -offset)
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        centre, _ = get_split(centre, p)
-    return centre
+    returns:
+      trimmed LineString or MultiLineString array, empty where line is no longer
+      than 2 * offset
+
+    """
+    n = len(line)
+    r = np.full(n, EMPTY, dtype=object)
+    part, row = get_parts(line, return_index=True)
+    ix = ~is_empty(part)
+    part, row = part[ix], row[ix]
+    if part.size == 0:
+        return r
+    xy, px, _, _ = get_coordinate_range(part)
+    ix = row[px]
+    start = np.searchsorted(ix, np.arange(n))
+    end = np.searchsorted(ix, np.arange(n), side="right") - 1
+    # distance of each vertex along its line, not counting gaps between parts
+    d = np.zeros(ix.size)
+    d[1:] = np.where(px[1:] == px[:-1], np.hypot(*np.diff(xy, axis=0).T), 0.0)
+    d = np.cumsum(d)
+    d = d - d[start[ix]]
+    a = np.full(n, offset)
+    b = np.where(start <= end, d[end], 0.0) - offset
+    keep = b > a
+    if not keep.any():
+        return r
+    # interpolate the cut points on the segments ending at vertex i and j
+    i = start + np.bincount(ix[d < a[ix]], minlength=n)
+    j = start + np.bincount(ix[d <= b[ix]], minlength=n)
+    k = np.flatnonzero(keep[ix] & (d > a[ix]) & (d < b[ix]))
+    i, j, a, b = i[keep], j[keep], a[keep], b[keep]
+    t = ((a - d[i - 1]) / (d[i] - d[i - 1]))[:, np.newaxis]
+    p = xy[i - 1] + t * (xy[i] - xy[i - 1])
+    t = ((b - d[j - 1]) / (d[j] - d[j - 1]))[:, np.newaxis]
+    q = xy[j - 1] + t * (xy[j] - xy[j - 1])
+    # order cut points and kept vertices along each line, and by part
+    order = np.argsort(np.r_[i - 0.75, k, j - 0.25], kind="stable")
+    coords = np.concatenate([p, xy[k], q])[order]
+    jx = np.r_[px[i], px[k], px[j]][order]
+    # drop a lone cut point where a cut falls on the end of a part
+    _, kx, count = np.unique(jx, return_inverse=True, return_counts=True)
+    ix = count[kx] > 1
+    kx, jx = np.unique(jx[ix], return_inverse=True)
+    s = linestrings(coords[ix], indices=jx)
+    # lines cut from more than one part are MultiLineString
+    kx, jx, count = np.unique(row[kx], return_inverse=True, return_counts=True)
+    s = multilinestrings(s, indices=jx)
+    r[kx] = np.where(count > 1, s, get_geometry(s, 0))
+    return r
 
 
 def get_segment_buffer(this_gs, radius):
     """get_segment:"""
-    r = this_gs.to_frame("geometry")
-    try:
-        r = gp.GeoSeries(this_gs.unary_union.geoms, crs=CRS)
-    except AttributeError:
-        r = gp.GeoSeries(this_gs, crs=CRS)
-    r = r.to_frame("geometry").reset_index(drop=True)
-    split_centre = partial(split_centres, offset=np.sqrt(1.5) * radius)
-    s = gp.GeoSeries(this_gs.map(split_centre), crs=CRS)
+    r = gp.GeoSeries(get_parts(unary_union(this_gs.values)), crs=CRS)
+    r = r.to_frame("geometry")
+    s = split_centres(this_gs.values, offset=np.sqrt(1.5) * radius)
+    s = gp.GeoSeries(s, crs=CRS)
     if s.is_empty.all():
         return r.buffer(0.612, 64, join_style="mitre", cap_style="round")
     s = s.buffer(radius, 0, join_style="round", cap_style="round")
     ix = s.is_empty.values
     s = s[~ix].reset_index(drop=True)
-    try:
-        s = gp.GeoSeries(s.unary_union.geoms, crs=CRS)
-    except AttributeError:
-        s = gp.GeoSeries(s.unary_union, crs=CRS)
+    s = gp.GeoSeries(get_parts(unary_union(s.values)), crs=CRS)
     i, j = r.sindex.query(s, predicate="intersects")
-    r["class"] = -1
-    r.loc[j, "class"] = s.index[i]
-    count = r.groupby("class").count()
-    r = r.join(count["geometry"].rename("count"), on="class")
-    ix = r["class"] == -1
-    r.loc[ix, "count"] = 0
-    ix = r["count"].isin([0, 1]).values
+    k = np.zeros(len(r), dtype=np.int64)
+    k[j] = i + 1
+    count = np.bincount(k, minlength=len(s) + 1)
+    count[0] = 0
+    ix = count[k] <= 1
     p = r[~ix]
     q = r[ix].buffer(0.612, 64, join_style="mitre", cap_style="round")
     if p.is_empty.all():
         return q
-    p = gp.GeoSeries(p.unary_union.geoms, crs=CRS)
+    p = gp.GeoSeries(get_parts(unary_union(p["geometry"].values)), crs=CRS)
     p = p.buffer(radius, join_style="round", cap_style="round")
-    try:
-        p = gp.GeoSeries(p.unary_union.geoms, crs=CRS)
-    except AttributeError:
-        p = gp.GeoSeries(p.unary_union, crs=CRS)
+    p = gp.GeoSeries(get_parts(unary_union(p.values)), crs=CRS)
     r = pd.concat([p, q])
     return r
 
@@ -295,13 +515,13 @@ def skeletonize_frame(this_gs, parameter):
     else:
         nx_geometry = get_geometry_buffer(this_gs, radius=radius)
     r_matrix, s_matrix, out_shape = get_affine_transform(nx_geometry, scale)
-    shapely_transform = partial(affine_transform, matrix=s_matrix)
     hole_size = 2.0 * radius * scale * scale
-    skeleton_im = get_skeleton(nx_geometry, r_matrix, out_shape, hole_size)
-    nx_point = get_raster_point(skeleton_im)
-    sx_line = get_raster_line(nx_point, parameter["knot"])
+    skeleton_im = get_skeleton(
+        nx_geometry, r_matrix, out_shape, hole_size, parameter["gpu"]
+    )
+    sx_line = get_raster_line(skeleton_im, parameter["knot"])
     tolerance = parameter["tolerance"]
-    return sx_to_nx(sx_line, shapely_transform, simplify=tolerance)
+    return sx_to_nx(sx_line, s_matrix, tolerance=tolerance)
 
 
 set_precision_pointone = partial(set_precision, grid_size=0.1)
@@ -323,14 +543,14 @@ def main():
     base_nx = get_base_geojson(parameter["inpath"])
     log("read geojson")
     outpath = parameter["outpath"]
-    write_dataframe(base_nx, outpath, layer="input")
+    write_dataframe(base_nx, outpath, layer="input", use_arrow=True)
     log("process\t")
     nx_line = skeletonize_frame(base_nx["geometry"], parameter)
     log("write simple")
-    write_dataframe(nx_line, outpath, "line")
+    write_dataframe(nx_line, outpath, "line", use_arrow=True)
     log("write primal")
     mx_line = get_nx(nx_line["geometry"]).to_frame("geometry")
-    write_dataframe(mx_line, outpath, "primal")
+    write_dataframe(mx_line, outpath, "primal", use_arrow=True)
     log("stop\t")
 
 
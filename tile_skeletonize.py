@@ -8,8 +8,18 @@ import geopandas as gp
 import numpy as np
 import pandas as pd
 from pyogrio import write_dataframe
-from shapely import STRtree, box, clip_by_rect, disjoint, voronoi_polygons
-from shapely.geometry import LineString, MultiPoint
+from shapely import (
+    STRtree,
+    box,
+    clip_by_rect,
+    disjoint,
+    get_coordinates,
+    get_parts,
+    linestrings,
+    unary_union,
+    voronoi_polygons,
+)
+from shapely.geometry import MultiPoint
 
 from shared import combine_line, CRS, get_base_geojson, get_nx, get_source_target, log
 from skeletonize import skeletonize_frame
@@ -39,6 +49,9 @@ def get_args():
     parser.add_argument("--scale", help="raster scale", type=float, default=1.0)
     parser.add_argument("--knot", help="keep image knots", action="store_true")
     parser.add_argument("--segment", help="segment", action="store_true")
+    parser.add_argument(
+        "--gpu", help="thin on GPU with cucim, differs from CPU", action="store_true"
+    )
     args = parser.parse_args()
     return {
         "inpath": args.inpath,
@@ -49,6 +62,7 @@ def get_args():
         "scale": args.scale,
         "knot": args.knot,
         "segment": args.segment,
+        "gpu": args.gpu,
     }
 
 
@@ -57,7 +71,7 @@ def get_square(this_gf, side_length=2000.0):
     returns:
       square tile GeoSeries
     """
-    dimension = np.asarray(this_gf.unary_union.bounds).reshape(-1, 2)
+    dimension = this_gf.total_bounds.reshape(-1, 2)
     outer_geometry = box(*dimension.reshape(-1))
     n, m = np.ceil(np.diff(dimension, axis=0).reshape(-1) / side_length + 2.0).astype(
         int
@@ -81,7 +95,8 @@ def clip_geometry(*bound, geometry):
 
 def get_tile_extent(this_nx, square, radius):
     """get_tile_extent:"""
-    get_clip_geometry = partial(clip_geometry, geometry=this_nx.unary_union)
+    union = unary_union(this_nx["geometry"].values)
+    get_clip_geometry = partial(clip_geometry, geometry=union)
     extent = square.buffer(3.0 * radius, join_style="mitre")
     r = gp.GeoSeries(extent.bounds.apply(get_clip_geometry, axis=1), crs=CRS)
     ix = r.is_empty
@@ -102,10 +117,11 @@ def get_gap_fill(this_gf, square, radius):
     node_tree = STRtree(end_node["geometry"])
     point = node_tree.geometries
     i, j = node_tree.query(point, predicate="dwithin", distance=radius / 2.0)
-    ix = i != j
-    ix = np.sort(np.stack([i[ix], j[ix]]).T, axis=1)
-    i, j = np.unique(ix, axis=0).T
-    r = gp.GeoSeries(map(LineString, zip(point[i], point[j])), crs=CRS)
+    ix = i < j
+    ix = np.unique(i[ix].astype(np.uint64) << 32 | j[ix].astype(np.uint64))
+    i, j = (ix >> 32).astype(np.int64), (ix & 0xFFFFFFFF).astype(np.int64)
+    xy = get_coordinates(point)
+    r = gp.GeoSeries(linestrings(np.stack([xy[i], xy[j]], axis=1)), crs=CRS)
     return r.to_frame("geometry")
 
 
@@ -123,10 +139,8 @@ def skeletonize_tiles(this_nx, parameter):
         v = v[~v.is_empty]
         if v.empty:
             continue
-        try:
-            v = clip_geometry(square[i].bounds, geometry=v.unary_union).geoms
-        except AttributeError:
-            v = clip_geometry(square[i].bounds, geometry=v.unary_union)
+        v = unary_union(v["geometry"].values)
+        v = get_parts(clip_geometry(square[i].bounds, geometry=v))
         v = gp.GeoSeries(v, crs=CRS).to_frame("geometry")
         v["id"] = i
         r.append(v)
@@ -145,14 +159,14 @@ def main():
     base_nx = get_base_geojson(parameter["inpath"])
     log("read geojson")
     outpath = parameter["outpath"]
-    write_dataframe(base_nx, outpath, layer="input")
+    write_dataframe(base_nx, outpath, layer="input", use_arrow=True)
     log("process\t")
     nx_line = skeletonize_tiles(base_nx, parameter)
     log("write simple")
-    write_dataframe(nx_line, outpath, "line")
+    write_dataframe(nx_line, outpath, "line", use_arrow=True)
     log("write primal")
     mx_line = get_nx(nx_line["geometry"]).to_frame("geometry")
-    write_dataframe(mx_line, outpath, "primal")
+    write_dataframe(mx_line, outpath, "primal", use_arrow=True)
     log("stop\t")
 
 
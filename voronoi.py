@@ -2,15 +2,22 @@
 """simplify.py: simplify GeoJSON network to GeoPKG layers using Voronoi polygons"""
 
 import argparse
-from functools import partial
 
 import geopandas as gp
 import numpy as np
 import pandas as pd
 from pyogrio import write_dataframe
-from shapely import box, get_coordinates, unary_union
-from shapely.geometry import LineString, MultiPoint, Point
-from shapely.ops import voronoi_diagram
+from shapely import (
+    STRtree,
+    box,
+    get_coordinates,
+    get_parts,
+    linestrings,
+    multipoints,
+    segmentize,
+    unary_union,
+    voronoi_polygons,
+)
 
 from shared import (
     combine_line,
@@ -62,14 +69,15 @@ def get_linestring(line):
     """get_linestring: return LineString GeoSeries from line coordinates
 
     args:
-      line:
+      line: GeoSeries LineString
 
     returns:
-       LineString GeoSeries
+       two-point LineString GeoSeries indexed by the source line
     """
-    r = get_coordinates(line)
-    r = np.stack([gp.points_from_xy(*r[:-1].T), gp.points_from_xy(*r[1:].T)])
-    return gp.GeoSeries(pd.DataFrame(r.T).apply(LineString, axis=1), crs=CRS).values
+    r, ix = get_coordinates(line.values, return_index=True)
+    jx = ix[1:] == ix[:-1]
+    r = np.stack([r[:-1][jx], r[1:][jx]], axis=1)
+    return gp.GeoSeries(linestrings(r), index=line.index[ix[:-1][jx]], crs=CRS)
 
 
 def get_segment(line, distance=50.0):
@@ -83,7 +91,8 @@ def get_segment(line, distance=50.0):
       GeoSeries of LineStrings of up to length distance
 
     """
-    return get_linestring(line.segmentize(distance))
+    r = gp.GeoSeries(segmentize(line.values, distance), index=line.index, crs=CRS)
+    return get_linestring(r)
 
 
 def get_segment_nx(line, scale):
@@ -97,9 +106,7 @@ def get_segment_nx(line, scale):
       segmented LineStrings
 
     """
-    set_segment = partial(get_segment, distance=scale)
-    r = line.map(set_segment).explode().rename("geometry")
-    return gp.GeoDataFrame(r, crs=CRS)
+    return get_segment(line, distance=scale).to_frame("geometry")
 
 
 def get_geometry_line(this_buffer):
@@ -127,29 +134,29 @@ def get_voronoi(this_buffer, tolerance, scale):
       Voronoi polygon
     """
     segment = get_segment_nx(this_buffer, scale).reset_index(drop=True)
-    point = segment.loc[:, "geometry"].map(get_coordinates).explode()
-    point = MultiPoint(point[::2].map(Point).values)
+    point = get_coordinates(segment["geometry"].values)
+    point = multipoints(point[::2])
     boundary = box(*point.bounds)
-    r = voronoi_diagram(point, envelope=boundary, tolerance=tolerance, edges=True)
-    r = gp.GeoSeries(map(set_precision_pointone, r.geoms), crs=CRS)
+    r = voronoi_polygons(point, tolerance=tolerance, extend_to=boundary, only_edges=True)
+    r = gp.GeoSeries(set_precision_pointone(get_parts(r)), crs=CRS)
     r = r.explode(index_parts=False).clip(boundary)
     ix = ~r.is_empty & (r.type == "LineString")
     return r[ix].reset_index(drop=True)
 
 
-def filter_distance(line, boundary, offset):
+def filter_distance(line, tree, offset):
     """filter_distance: filter line closer than distance offset from boundary
 
     args:
       line:     LineStrings to simplify
-      boundary: boundary LineString
+      tree:     boundary LineString STRtree
       offset:
 
     returns:
       simplified LineStrings
     """
     edge, _ = get_source_target(line.to_frame("geometry"))
-    (ix, _), distance = boundary.sindex.nearest(edge["geometry"], return_distance=True)
+    (ix, _), distance = tree.query_nearest(edge["geometry"].values, return_distance=True)
     _, ix = np.unique(ix, return_index=True)
     ix = distance[ix] > offset
     return combine_line(edge.loc[ix, "geometry"]).simplify(1.0)
@@ -181,14 +188,14 @@ def set_geometry(line, square):
 
     """
     r = line.reset_index(drop=True)
-    centroid = square.centroid.map(set_precision_pointone).set_crs(CRS)
+    centroid = set_precision_pointone(square.centroid.values)
+    centroid = gp.GeoSeries(centroid, index=square.index, crs=CRS)
     edge, node = get_source_target(r)
     ix = node["geometry"].sindex.query(square, predicate="contains_properly")
     node.loc[ix[1], "geometry"] = centroid[ix[0]].values
-    source = node.loc[edge["source"], "geometry"].values
-    target = node.loc[edge["target"], "geometry"].values
-    r = np.stack([source, target]).T
-    return gp.GeoSeries(map(LineString, r), crs=CRS)
+    xy = get_coordinates(node["geometry"].values)
+    r = np.stack([xy[edge["source"].values], xy[edge["target"].values]], axis=1)
+    return gp.GeoSeries(linestrings(r), crs=CRS)
 
 
 def get_voronoi_line(voronoi, boundary, geometry, buffer_size):
@@ -206,13 +213,13 @@ def get_voronoi_line(voronoi, boundary, geometry, buffer_size):
 
     """
     offset = buffer_size / 2.0
-    r = filter_distance(voronoi, boundary, offset)
+    r = filter_distance(voronoi, STRtree(boundary.values), offset)
     r = filter_buffer(r, geometry)
     edge, node = get_source_target(r.to_frame("geometry"))
     ix = node["count"] < 4
     square = node[ix].buffer(offset, cap_style="square", mitre_limit=offset)
-    square = gp.GeoSeries(unary_union(square.values).geoms, crs=CRS)
-    r = edge["geometry"].map(get_linestring).explode().to_frame("geometry")
+    square = gp.GeoSeries(get_parts(unary_union(square.values)), crs=CRS)
+    r = get_linestring(edge["geometry"]).to_frame("geometry")
     r = set_geometry(r, square)
     return combine_line(r)
 
@@ -239,7 +246,7 @@ def main():
     base_nx = get_base_geojson(parameter["inpath"])
     log("read geojson")
     outpath = parameter["outpath"]
-    write_dataframe(base_nx, outpath, layer="input")
+    write_dataframe(base_nx, outpath, layer="input", use_arrow=True)
     log("process\t")
     radius = parameter["buffer"]
     nx_geometry = get_geometry_buffer(base_nx["geometry"], radius=radius)
@@ -251,10 +258,11 @@ def main():
     simplify = parameter["simplify"]
     if simplify > 0.0:
         nx_line = nx_line.simplify(simplify)
-    write_dataframe(nx_line.to_frame("geometry"), outpath, layer="line")
-    nx_edge = get_nx(nx_line)
+    nx_line = nx_line.to_frame("geometry")
+    write_dataframe(nx_line, outpath, layer="line", use_arrow=True)
+    nx_edge = get_nx(nx_line["geometry"]).to_frame("geometry")
     log("write primal")
-    write_dataframe(nx_edge.to_frame("geometry"), outpath, layer="primal")
+    write_dataframe(nx_edge, outpath, layer="primal", use_arrow=True)
     log("stop\t")
 
 